@@ -1,18 +1,42 @@
 import os
 import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
 
 
 class FileCache:
-    def __init__(self, cache_dir="data"):
+    def __init__(self, cache_dir="data", memory_size=256, ttl=None):
         """
         Initialize the file cache.
 
         Args:
             cache_dir (str): The directory where cached objects will be stored
+            memory_size (int): The number of recently used objects kept in memory
+            ttl (float | None): Seconds after which an object is treated as
+                missing, or None to keep objects until they are deleted
         """
         self.cache_dir = cache_dir
         os.makedirs(cache_dir, exist_ok=True)
 
+        self.ttl = ttl
+        self._mem: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._mem_max = memory_size
+        self._lock = threading.Lock()
+        self._pruned_at = 0.0
+
+    def _expired(self, stored_at):
+        return self.ttl is not None and time.time() - stored_at >= self.ttl
+
+    def _remember(self, key, stored_at, value):
+        with self._lock:
+            self._mem[key] = (stored_at, value)
+            self._mem.move_to_end(key)
+            if len(self._mem) > self._mem_max:
+                self._mem.popitem(last=False)
+
     def get(self, key):
         """
         Retrieve an object from cache by key.
@@ -23,17 +47,30 @@ class FileCache:
         Returns:
             The cached object if it exists, None otherwise
         """
-        file_path = os.path.join(self.cache_dir, str(key))
+        key = str(key)
+        with self._lock:
+            if key in self._mem:
+                stored_at, value = self._mem[key]
+                if not self._expired(stored_at):
+                    self._mem.move_to_end(key)
+                    return value
+                del self._mem[key]
 
-        if not os.path.exists(file_path):
-            return None
+        file_path = os.path.join(self.cache_dir, key)
 
         try:
+            stored_at = os.path.getmtime(file_path)
+            if self._expired(stored_at):
+                os.remove(file_path)
+                return None
             with open(file_path, "rb") as f:
-                return pickle.load(f)
+                value = pickle.load(f)
         except (pickle.PickleError, EOFError, IOError):
             return None
 
+        self._remember(key, stored_at, value)
+        return value
+
     def set(self, key, value):
         """
         Store an object in cache with the given key.
@@ -42,10 +79,45 @@ class FileCache:
             key (str): The key to store the object under
             value: The object to cache
         """
-        file_path = os.path.join(self.cache_dir, str(key))
+        key = str(key)
+        file_path = os.path.join(self.cache_dir, key)
+
+        # The object is written to a temporary file and moved into place, so
+        # concurrent writers and readers never see a partly written file.
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        self._remember(key, os.path.getmtime(file_path), value)
 
-        with open(file_path, "wb") as f:
-            pickle.dump(value, f)
+        if self.ttl is not None and time.time() - self._pruned_at >= self.ttl:
+            self._pruned_at = time.time()
+            self.prune()
+
+    def prune(self):
+        """
+        Remove expired objects from the cache directory.
+        """
+        with self._lock:
+            for key, (stored_at, _) in list(self._mem.items()):
+                if self._expired(stored_at):
+                    del self._mem[key]
+
+        if self.ttl is None:
+            return
+
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and self._expired(entry.stat().st_mtime):
+                        os.remove(entry.path)
+                except OSError:
+                    pass
 
     def delete(self, key):
         """
@@ -54,10 +126,16 @@ class FileCache:
         Args:
             key (str): The key to delete from the cache
         """
-        file_path = os.path.join(self.cache_dir, str(key))
+        key = str(key)
+        with self._lock:
+            self._mem.pop(key, None)
+
+        file_path = os.path.join(self.cache_dir, key)
 
-        if os.path.exists(file_path):
+        try:
             os.remove(file_path)
+        except FileNotFoundError:
+            pass
 
     def exists(self, key):
         """
@@ -69,5 +147,13 @@ class FileCache:
         Returns:
             bool: True if the object exists, False otherwise
         """
-        file_path = os.path.join(self.cache_dir, str(key))
-        return os.path.exists(file_path)
+        key = str(key)
+        with self._lock:
+            if key in self._mem and not self._expired(self._mem[key][0]):
+                return True
+
+        file_path = os.path.join(self.cache_dir, key)
+        try:
+            return not self._expired(os.path.getmtime(file_path))
+        except OSError:
+            return False
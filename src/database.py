@@ -1,15 +1,50 @@
+import queue
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from contextlib import contextmanager
 
 DB_PATH = "sessions.db"
+READ_POOL_SIZE = 4
+
+PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA temp_store=memory",
+)
+
+_read_pool: queue.Queue[sqlite3.Connection] = queue.Queue()
+_write_conn: sqlite3.Connection | None = None
+_write_cursor: sqlite3.Cursor | None = None
+_write_lock = threading.Lock()
+
+# Sessions are looked up on every request, so recently used ones are kept in
+# an in-memory LRU for a short while. Entries are dropped when a session is
+# replaced or deleted.
+SESSION_CACHE_SIZE = 10_000
+SESSION_CACHE_TTL = 60
+
+_session_cache: OrderedDict[str, tuple[float, tuple[str, str]]] = OrderedDict()
+_session_cache_lock = threading.Lock()
+
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
 
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    global _write_conn, _write_cursor
+
+    conn = _connect()
+    conn.execute("PRAGMA journal_mode=WAL")
 
     # Create sessions table
-    cursor.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS sessions (
             id TEXT PRIMARY KEY,
             access_token TEXT NOT NULL,
@@ -18,44 +53,77 @@ def init_db():
         )
     """)
 
-    conn.commit()
-    conn.close()
+    _write_conn = conn
+    _write_cursor = conn.cursor()
+    for _ in range(READ_POOL_SIZE):
+        _read_pool.put(_connect())
 
 
 @contextmanager
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = _read_pool.get()
     try:
         yield conn
     finally:
-        conn.close()
+        _read_pool.put(conn)
+
+
+@contextmanager
+def get_write_cursor():
+    # The writer keeps one long-lived cursor; sqlite3 caches the compiled
+    # statements per connection, so repeated writes skip parsing and planning.
+    with _write_lock:
+        _write_cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield _write_cursor
+        except BaseException:
+            _write_cursor.execute("ROLLBACK")
+            raise
+        else:
+            _write_cursor.execute("COMMIT")
 
 
 def create_session(session_id, access_token, user):
-    with get_db() as conn:
-        cursor = conn.cursor()
+    with get_write_cursor() as cursor:
         cursor.execute(
             "INSERT OR REPLACE INTO sessions (id, access_token, user) VALUES (?, ?, ?)",
             (session_id, access_token, user),
         )
-        conn.commit()
+
+    with _session_cache_lock:
+        _session_cache.pop(session_id, None)
 
 
 def get_session(session_id):
+    now = time.monotonic()
+    with _session_cache_lock:
+        cached = _session_cache.get(session_id)
+        if cached is not None and cached[0] > now:
+            _session_cache.move_to_end(session_id)
+            return cached[1]
+
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "SELECT access_token, user FROM sessions WHERE id = ?", (session_id,)
         )
         row = cursor.fetchone()
-        return row
+
+    if row is not None:
+        with _session_cache_lock:
+            _session_cache[session_id] = (now + SESSION_CACHE_TTL, row)
+            _session_cache.move_to_end(session_id)
+            if len(_session_cache) > SESSION_CACHE_SIZE:
+                _session_cache.popitem(last=False)
+    return row
 
 
 def delete_session(session_id):
-    with get_db() as conn:
-        cursor = conn.cursor()
+    with get_write_cursor() as cursor:
         cursor.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
-        conn.commit()
+
+    with _session_cache_lock:
+        _session_cache.pop(session_id, None)
 
 
 # Initialize database on import
@@ -1,10 +1,101 @@
 import io
-from datetime import datetime
+import math
+import tempfile
+from typing import BinaryIO, Iterable
 
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
-from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+from reportlab.platypus import (
+    LongTable,
+    Paragraph,
+    SimpleDocTemplate,
+    Spacer,
+    Table,
+    TableStyle,
+)
+
+# Styles carry no per-document state, so they are built once per process.
+STYLES = getSampleStyleSheet()
+TITLE_STYLE = ParagraphStyle(
+    "CustomTitle",
+    parent=STYLES["Heading1"],
+    fontSize=18,
+    spaceAfter=30,
+    alignment=0,
+)
+HEADING_STYLE = ParagraphStyle(
+    "CustomHeading",
+    parent=STYLES["Heading2"],
+    fontSize=12,
+    spaceAfter=15,
+    alignment=0,
+)
+
+LINE_TABLE_STYLE = TableStyle(
+    [
+        ("ALIGN", (0, 0), (-1, -1), "RIGHT"),
+        # ("GRID", (0, 0), (-1, -1), 1, colors.black),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("FONTSIZE", (0, 0), (-1, -1), 10),
+        ("BOTTOMPADDING", (0, 0), (-1, -1), 5),
+        ("LINEABOVE", (0, -1), (-1, -1), 1, colors.black),
+        ("LINEBELOW", (0, -1), (-1, -1), 1, colors.black),
+        (
+            "TEXTCOLOR",
+            (0, -1),
+            (-1, -1),
+            colors.black,
+        ),
+        (
+            "FONTNAME",
+            (0, -1),
+            (-1, -1),
+            "Helvetica",
+        ),
+        ("BOTTOMPADDING", (0, -1), (-1, -1), 5),
+        (
+            "ALIGN",
+            (0, 0),
+            (0, -1),
+            "LEFT",
+        ),
+        ("FONTSIZE", (0, -1), (-1, -1), 12),
+    ]
+)
+
+USAGE_TABLE_STYLE = TableStyle(
+    [
+        # ("BACKGROUND", (0, 0), (-1, 0), colors.grey),
+        # ("TEXTCOLOR", (0, 0), (-1, 0), colors.whitesmoke),
+        ("ALIGN", (0, 0), (-1, -1), "LEFT"),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("FONTSIZE", (0, 0), (-1, -1), 10),
+        ("BOTTOMPADDING", (0, 0), (-1, -1), 5),
+        ("LINEABOVE", (0, -1), (-1, -1), 1, colors.black),
+        ("LINEBELOW", (0, -1), (-1, -1), 1, colors.black),
+        (
+            "TEXTCOLOR",
+            (0, -1),
+            (-1, -1),
+            colors.black,
+        ),
+        (
+            "FONTNAME",
+            (0, -1),
+            (-1, -1),
+            "Helvetica-Bold",
+        ),
+        ("FONTSIZE", (0, -1), (-1, -1), 10),
+        ("BOTTOMPADDING", (0, -1), (-1, -1), 5),
+        (
+            "ALIGN",
+            (-1, 0),
+            (-1, -1),
+            "RIGHT",
+        ),
+    ]
+)
 
 
 def generate_invoice_pdf(
@@ -12,12 +103,84 @@ def generate_invoice_pdf(
     installation_name: str | None,
     year: str,
     month: int,
-    sessions_data: list,
-    total_kwh: float | int,
+    sessions_data: Iterable,
     nok_per_kwh: float | int,
-    total_cost: float | int,
-):
+) -> tuple[bytes, float, float]:
+    """
+    Render the invoice basis for one installation in memory.
+
+    Returns:
+        tuple: The PDF bytes, the total kWh and the total cost ex. VAT
+    """
     buffer = io.BytesIO()
+    total_kwh, total_cost = write_invoice_pdf(
+        buffer,
+        installation_id,
+        installation_name,
+        year,
+        month,
+        sessions_data,
+        nok_per_kwh,
+    )
+    pdf_bytes = buffer.getvalue()
+    buffer.close()
+
+    return pdf_bytes, total_kwh, total_cost
+
+
+def spool_invoice_pdf(
+    installation_id: str,
+    installation_name: str | None,
+    year: str,
+    month: int,
+    sessions_data: Iterable,
+    nok_per_kwh: float | int,
+) -> BinaryIO:
+    """
+    Render the invoice basis for one installation into a temporary file.
+
+    The document is written to a spooled temporary file, so small invoices stay
+    in memory while large ones spill to disk instead of being held as bytes.
+
+    Returns:
+        BinaryIO: The rendered PDF, rewound to the start. The caller closes it.
+    """
+    target = tempfile.SpooledTemporaryFile(max_size=1_000_000)
+    try:
+        write_invoice_pdf(
+            target,
+            installation_id,
+            installation_name,
+            year,
+            month,
+            sessions_data,
+            nok_per_kwh,
+        )
+    except BaseException:
+        target.close()
+        raise
+    target.seek(0)
+    return target
+
+
+def write_invoice_pdf(
+    target: BinaryIO,
+    installation_id: str,
+    installation_name: str | None,
+    year: str,
+    month: int,
+    sessions_data: Iterable,
+    nok_per_kwh: float | int,
+) -> tuple[float, float]:
+    """
+    Render the invoice basis for one installation into a file-like target.
+
+    The energies are collected while the usage rows are built, so the sessions
+    are only traversed once and may be given as any iterable.
+
+    Returns:
+        tuple: The total kWh and the total cost ex. VAT
+    """
     page_width, page_height = A4
 
     left_margin = 30
@@ -28,7 +191,7 @@ def generate_invoice_pdf(
     content_height = page_height - top_margin - bottom_margin
 
     doc = SimpleDocTemplate(
-        buffer,
+        target,
         pagesize=A4,
         leftMargin=left_margin,
         rightMargin=right_margin,
@@ -36,27 +199,35 @@ def generate_invoice_pdf(
         bottomMargin=bottom_margin,
     )
 
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle(
-        "CustomTitle",
-        parent=styles["Heading1"],
-        fontSize=18,
-        spaceAfter=30,
-        alignment=0,
-    )
+    usage_headers = [
+        "Starttidspunkt",
+        "Sluttidspunkt",
+        "Ladeenhet",
+        "Strømforbruk (kWh)",
+    ]
+    usage_data = [usage_headers]
+    energies = []
+
+    for session in sessions_data:
+        energies.append(session.energy)
+
+        row = [
+            format_timestamp(session.start_time),
+            format_timestamp(session.end_time),
+            session.device_name,
+            str(session.energy),
+        ]
+        usage_data.append(row)
+
+    # fsum is exact, so long months do not accumulate floating point error.
+    total_kwh = round(math.fsum(energies), 3)
+    total_cost = round(total_kwh * nok_per_kwh, 2)
 
-    heading_style = ParagraphStyle(
-        "CustomHeading",
-        parent=styles["Heading2"],
-        fontSize=12,
-        spaceAfter=15,
-        alignment=0,
-    )
     elements = []
 
     title = Paragraph(
         f"Fakturagrunnlag elbillader {installation_name or installation_id}",
-        title_style,
+        TITLE_STYLE,
     )
     elements.append(title)
 
@@ -65,7 +236,7 @@ def generate_invoice_pdf(
         norwegian_date_str = f"{month:02d}"
 
     period = f"For {norwegian_date_str} {year} er den gjennomsnittlige strømprisen {nok_per_kwh:.2f} NOK per kWh, ekskl. mva."
-    elements.append(Paragraph(period, styles["Normal"]))
+    elements.append(Paragraph(period, STYLES["Normal"]))
 
     elements.append(Spacer(1, 20))
 
@@ -87,78 +258,18 @@ def generate_invoice_pdf(
             content_width * (4 / 12),
         ],
     )
-    line_table.setStyle(
-        TableStyle(
-            [
-                ("ALIGN", (0, 0), (-1, -1), "RIGHT"),
-                # ("GRID", (0, 0), (-1, -1), 1, colors.black),
-                ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-                ("FONTSIZE", (0, 0), (-1, -1), 10),
-                ("BOTTOMPADDING", (0, 0), (-1, -1), 5),
-                ("LINEABOVE", (0, -1), (-1, -1), 1, colors.black),
-                ("LINEBELOW", (0, -1), (-1, -1), 1, colors.black),
-                (
-                    "TEXTCOLOR",
-                    (0, -1),
-                    (-1, -1),
-                    colors.black,
-                ),
-                (
-                    "FONTNAME",
-                    (0, -1),
-                    (-1, -1),
-                    "Helvetica",
-                ),
-                ("BOTTOMPADDING", (0, -1), (-1, -1), 5),
-                (
-                    "ALIGN",
-                    (0, 0),
-                    (0, -1),
-                    "LEFT",
-                ),
-                ("FONTSIZE", (0, -1), (-1, -1), 12),
-            ]
-        )
-    )
+    line_table.setStyle(LINE_TABLE_STYLE)
     elements.append(line_table)
 
     elements.append(Spacer(1, 20))
 
-    elements.append(Paragraph("Detaljert strømforbruk for perioden", heading_style))
-
-    if sessions_data:
-        usage_headers = [
-            "Starttidspunkt",
-            "Sluttidspunkt",
-            "Ladeenhet",
-            "Strømforbruk (kWh)",
-        ]
-        usage_data = [usage_headers]
-
-        for session in sessions_data:
-            start_time = session.get("StartDateTime", "N/A")
-            end_time = session.get("EndDateTime", "N/A")
-
-            try:
-                if start_time != "N/A":
-                    dt = datetime.fromisoformat(start_time)
-                    start_time = dt.strftime("%Y-%m-%d %H:%M")
-                if end_time != "N/A":
-                    dt = datetime.fromisoformat(end_time)
-                    end_time = dt.strftime("%Y-%m-%d %H:%M")
-            except Exception:
-                pass
-
-            row = [
-                start_time,
-                end_time,
-                session.get("DeviceName", "N/A"),
-                str(session.get("Energy", 0)),
-            ]
-            usage_data.append(row)
+    elements.append(Paragraph("Detaljert strømforbruk for perioden", HEADING_STYLE))
 
+    if energies:
         usage_data.append(["Sum kWh", "", "", f"{total_kwh:.3f}"])
-        usage_table = Table(
+        # LongTable lays out large tables faster and repeats the header row on
+        # every page.
+        usage_table = LongTable(
             usage_data,
             colWidths=[
                 0.25 * content_width,
@@ -166,54 +277,37 @@ def generate_invoice_pdf(
                 0.25 * content_width,
                 0.25 * content_width,
             ],
+            repeatRows=1,
         )
-        usage_table.setStyle(
-            TableStyle(
-                [
-                    # ("BACKGROUND", (0, 0), (-1, 0), colors.grey),
-                    # ("TEXTCOLOR", (0, 0), (-1, 0), colors.whitesmoke),
-                    ("ALIGN", (0, 0), (-1, -1), "LEFT"),
-                    ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
-                    ("FONTSIZE", (0, 0), (-1, -1), 10),
-                    ("BOTTOMPADDING", (0, 0), (-1, -1), 5),
-                    ("LINEABOVE", (0, -1), (-1, -1), 1, colors.black),
-                    ("LINEBELOW", (0, -1), (-1, -1), 1, colors.black),
-                    (
-                        "TEXTCOLOR",
-                        (0, -1),
-                        (-1, -1),
-                        colors.black,
-                    ),
-                    (
-                        "FONTNAME",
-                        (0, -1),
-                        (-1, -1),
-                        "Helvetica-Bold",
-                    ),
-                    ("FONTSIZE", (0, -1), (-1, -1), 10),
-                    ("BOTTOMPADDING", (0, -1), (-1, -1), 5),
-                    (
-                        "ALIGN",
-                        (-1, 0),
-                        (-1, -1),
-                        "RIGHT",
-                    ),
-                ]
-            )
-        )
+        usage_table.setStyle(USAGE_TABLE_STYLE)
         elements.append(usage_table)
     else:
         elements.append(
-            Paragraph("Ingen ladesesjoner funnet for denne perioden.", styles["Normal"])
+            Paragraph("Ingen ladesesjoner funnet for denne perioden.", STYLES["Normal"])
         )
 
     doc.build(elements)
 
-    buffer.seek(0)
-    pdf_bytes = buffer.read()
-    buffer.close()
+    return total_kwh, total_cost
 
-    return pdf_bytes
+
+def format_timestamp(timestamp):
+    """
+    Format an ISO 8601 timestamp as "YYYY-MM-DD HH:MM".
+
+    The date and local time are sliced out of the string, so the wall-clock
+    time is kept as given. Values that are not timestamps, such as "N/A", are
+    returned unchanged.
+
+    Args:
+        timestamp (str): The timestamp to format
+
+    Returns:
+        str: The formatted timestamp
+    """
+    if not timestamp or len(timestamp) < 16 or timestamp[10] != "T":
+        return timestamp
+    return f"{timestamp[:10]} {timestamp[11:16]}"
 
 
 def format_norwegian_accounting(number):
@@ -226,34 +320,9 @@ def format_norwegian_accounting(number):
     Returns:
         str: Formatted string in Norwegian accounting style
     """
-    number = float(number)
-
-    integer_part = int(number)
-    decimal_part = round((number - integer_part) * 100)
-
-    is_negative = integer_part < 0
-    if is_negative:
-        integer_part = abs(integer_part)
-
-    int_str = str(integer_part)
-
-    formatted_int = ""
-    for i, digit in enumerate(reversed(int_str)):
-        if i > 0 and i % 3 == 0:
-            formatted_int = " " + formatted_int
-        formatted_int = digit + formatted_int
-
-    if decimal_part < 10:
-        decimal_str = f"0{decimal_part}"
-    else:
-        decimal_str = str(decimal_part)
-
-    result = f"{formatted_int},{decimal_str}"
-
-    if is_negative:
-        result = f"-{result}"
-
-    return result
+    formatted = f"{float(number):,.2f}"
+    integer_part, decimal_part = formatted.split(".")
+    return f"{integer_part.replace(',', ' ')},{decimal_part}"
 
 
 def format_month_to_norwegian(month_int: int) -> int | None:
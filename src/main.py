@@ -1,27 +1,127 @@
+import asyncio
+import base64
+import hashlib
+import http.cookiejar
 import io
+import logging
+import multiprocessing
+import os
 import re
 import secrets
+import tempfile
 import zipfile
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import aclosing, asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Annotated, BinaryIO, Iterator
 
 import httpx
+import jinja2
 import polars as pl
-from fastapi import Depends, FastAPI, Form, Request, Response
+from fastapi import Depends, FastAPI, Form, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.templating import Jinja2Templates
+from pydantic import BaseModel, Field
 
+from cache import FileCache
 from database import create_session, delete_session, get_session
-from invoice import generate_invoice_pdf
-from zaptec_api import ZaptecAPI
-
-app = FastAPI()
-templates = Jinja2Templates(directory="templates")
+from invoice import generate_invoice_pdf, spool_invoice_pdf
+from zaptec_api import ChargeSession, ZaptecAPI
 
 ZAPTEC_API_URL = "https://api.zaptec.com"
-TOKEN_URL = f"{ZAPTEC_API_URL}/oauth/token"
+TOKEN_URL = "/oauth/token"
+
+UNSAFE_FILENAME_RE = re.compile(r'[<>:"/\\|?*]')
+
+PDF_WORKERS = os.cpu_count() or 1
+
+# Charge history requests are limited per export, so a large account does not
+# queue more requests on the shared client than it has connections for.
+CHARGEHISTORY_CONCURRENCY = 8
+
+# Export archives larger than this are spooled to disk while they are built.
+ARCHIVE_SPOOL_SIZE = 8 * 1024 * 1024
+
+# Zaptec can receive sessions from offline chargers long after they ended, so
+# cached charge history for a closed month is only trusted for a while.
+CHARGEHISTORY_CACHE_TTL = 60 * 60
+
+chargehistory_cache = FileCache("data/zaptec", ttl=CHARGEHISTORY_CACHE_TTL)
+
+logger = logging.getLogger(__name__)
+
+
+def new_pdf_executor() -> ProcessPoolExecutor:
+    # ReportLab is pure Python, so PDFs are rendered in worker processes to use
+    # all cores without blocking the event loop. Workers are spawned rather than
+    # forked since the server process is multi-threaded.
+    return ProcessPoolExecutor(
+        max_workers=PDF_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
 
-zaptec_api = ZaptecAPI(ZAPTEC_API_URL)
+
+def replace_pdf_executor(app: FastAPI, broken: ProcessPoolExecutor) -> None:
+    # A pool whose worker died stays broken for good, so it is swapped for a
+    # new one. Requests that saw the same pool break only replace it once.
+    if app.state.pdf_executor is broken:
+        broken.shutdown(wait=False, cancel_futures=True)
+        app.state.pdf_executor = new_pdf_executor()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.pdf_executor = new_pdf_executor()
+    # A single client is shared by all requests so connections to Zaptec are
+    # kept alive and reused instead of being set up for every call.
+    async with httpx.AsyncClient(
+        base_url=ZAPTEC_API_URL,
+        headers={"User-Agent": "zaptecfaktura/1.0"},
+        # The client is shared between users, so cookies set by Zaptec must not
+        # be stored and sent along with other users' requests.
+        # The jar is passed as is; wrapping it in httpx.Cookies would copy its
+        # contents into a jar with the default, permissive policy.
+        cookies=http.cookiejar.CookieJar(
+            policy=http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+        ),
+        # Exports fan out over several installations and pages, so requests
+        # may queue for a free connection. They get as long to wait as a slow
+        # response is given to arrive.
+        timeout=httpx.Timeout(connect=5.0, read=30.0, write=10.0, pool=30.0),
+        limits=httpx.Limits(
+            max_connections=50,
+            max_keepalive_connections=20,
+            keepalive_expiry=60.0,
+        ),
+    ) as client:
+        app.state.http = client
+        app.state.zaptec_api = ZaptecAPI(client)
+        try:
+            yield
+        finally:
+            app.state.pdf_executor.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+# Templates do not change while the server runs, so they are compiled once and
+# never checked on disk again.
+templates = Jinja2Templates(
+    env=jinja2.Environment(
+        loader=jinja2.FileSystemLoader("templates"),
+        auto_reload=False,
+        cache_size=-1,
+        autoescape=jinja2.select_autoescape(["html"]),
+    )
+)
+
+
+def get_zaptec_api(request: Request) -> ZaptecAPI:
+    return request.app.state.zaptec_api
 
 
 @app.middleware("http")
@@ -42,20 +142,60 @@ async def auth_middleware(request: Request, call_next):
         response.delete_cookie("session_id")
         return response
 
+    request.state.session = session_data
     response = await call_next(request)
     return response
 
 
 async def get_token(request: Request) -> str | None:
-    session_id = request.cookies.get("session_id")
-    if not session_id:
+    # The session has already been looked up by auth_middleware.
+    session_data = getattr(request.state, "session", None)
+    if not session_data:
         return None
 
-    session_data = get_session(session_id)
+    return session_data[0]  # access_token
+
+
+async def get_user(request: Request) -> str | None:
+    session_data = getattr(request.state, "session", None)
     if not session_data:
-        return
+        return None
 
-    return session_data[0]  # access_token
+    return session_data[1]  # user
+
+
+async def get_chargehistory(
+    zaptec_api: ZaptecAPI,
+    token: str,
+    user: str,
+    installation_id: str,
+    from_date: str,
+    to_date: str,
+) -> list[ChargeSession]:
+    """
+    Fetch charge history, reusing earlier results for periods that have ended.
+
+    Sessions in a closed period rarely change, so they are cached per user for
+    CHARGEHISTORY_CACHE_TTL and repeated exports of the same month skip the
+    Zaptec round trip. A day of grace is given for sessions that were still
+    running at the end.
+    """
+    key = hashlib.sha256(
+        f"{user}:{installation_id}:{from_date}:{to_date}".encode()
+    ).hexdigest()
+    sessions_data = await run_in_threadpool(chargehistory_cache.get, key)
+    if sessions_data is not None:
+        return sessions_data
+
+    sessions_data = await zaptec_api.get_chargehistory(
+        token,
+        installation_id,
+        from_date,
+        to_date,
+    )
+    if datetime.fromisoformat(to_date) < datetime.now(timezone.utc) - timedelta(days=1):
+        await run_in_threadpool(chargehistory_cache.set, key, sessions_data)
+    return sessions_data
 
 
 @app.get("/login", response_class=HTMLResponse)
@@ -65,15 +205,14 @@ async def login_page(request: Request):
 
 @app.post("/login", response_class=HTMLResponse)
 async def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            TOKEN_URL,
-            data={
-                "grant_type": "password",
-                "username": form_data.username,
-                "password": form_data.password,
-            },
-        )
+    response = await request.app.state.http.post(
+        TOKEN_URL,
+        data={
+            "grant_type": "password",
+            "username": form_data.username,
+            "password": form_data.password,
+        },
+    )
 
     if response.status_code != 200:
         return templates.TemplateResponse(
@@ -81,7 +220,9 @@ async def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends
         )
 
     token_data = response.json()
-    session_id = secrets.token_urlsafe(32)
+    # 192 bits of entropy; 24 bytes encode to exactly 32 characters without
+    # any base64 padding to strip.
+    session_id = base64.urlsafe_b64encode(secrets.token_bytes(24)).decode("ascii")
 
     create_session(session_id, token_data["access_token"], form_data.username)
 
@@ -90,93 +231,126 @@ async def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends
     return response
 
 
+ERROR_MESSAGES = {
+    "installations": "Could not fetch the installations",
+    "chargehistory": "Could not fetch the charge history",
+    "pdf": "Could not create the invoice documents",
+}
+
+
 @app.get("/", response_class=HTMLResponse)
-async def get_home(request: Request, token: str = Depends(get_token)):
+async def get_home(
+    request: Request, error: str | None = None, token: str = Depends(get_token)
+):
+    now = datetime.now()
     return templates.TemplateResponse(
         "home.html",
         {
             "request": request,
-            "year": datetime.now().year,
-            "month": datetime.now().month,
+            "year": now.year,
+            "month": now.month,
+            "error": ERROR_MESSAGES.get(error),
         },
     )
 
 
+class ExportAllForm(BaseModel):
+    year: int = Field(ge=2000, le=2100)
+    month: int = Field(ge=1, le=12)
+    nok_per_kwh: float = Field(ge=0, allow_inf_nan=False)
+
+
+class ExportForm(ExportAllForm):
+    installation_id: str
+    installation_name: str
+
+
+@lru_cache(maxsize=256)
+def month_bounds(year: int, month: int) -> tuple[str, str]:
+    """Return the ISO timestamps for the start of the month and the next one."""
+    start = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1)
+    return f"{start:%Y-%m-%d}T00:00:00Z", f"{end:%Y-%m-%d}T00:00:00Z"
+
+
+def redirect_with_error(error: str) -> RedirectResponse:
+    # Failed exports go back to the form, which shows the message. Rendering it
+    # on the following GET keeps the page refreshable. Only a code from
+    # ERROR_MESSAGES is passed, so a link cannot put its own text on the page.
+    return RedirectResponse(url=f"/?error={error}", status_code=303)
+
+
 @app.post("/export", response_class=HTMLResponse)
 async def export_usage(
     request: Request,
-    installation_id: str = Form(...),
-    installation_name: str = Form(...),
-    year: int = Form(...),
-    month: int = Form(...),
-    nok_per_kwh: float = Form(...),
+    form: Annotated[ExportForm, Form()],
     token: str = Depends(get_token),
+    user: str = Depends(get_user),
+    zaptec_api: ZaptecAPI = Depends(get_zaptec_api),
 ):
-    if not (1 <= month <= 12) or year < 2000:
-        return templates.TemplateResponse(
-            "installations.html", {"request": request, "error": "Invalid date"}
-        )
-    if nok_per_kwh < 0:
-        return templates.TemplateResponse(
-            "installations.html", {"request": request, "error": "Invalid NOK per kWh"}
-        )
-
-    from_date = f"{year}-{month:02d}-01T00:00:00Z"
-
-    if month == 12:
-        to_date = f"{year + 1}-01-01T00:00:00Z"
-    else:
-        to_date = f"{year}-{month + 1:02d}-01T00:00:00Z"
+    from_date, to_date = month_bounds(form.year, form.month)
 
     try:
-        sessions_data = await zaptec_api.get_chargehistory(
+        sessions_data = await get_chargehistory(
+            zaptec_api,
             token,
-            installation_id,
+            user,
+            form.installation_id,
             from_date,
             to_date,
         )
-    except Exception as e:
-        return templates.TemplateResponse(
-            "installations.html",
-            {"request": request, "error": str(e)},
+    except Exception:
+        logger.exception(
+            "Failed to fetch charge history for installation %s",
+            form.installation_id,
         )
+        return redirect_with_error("chargehistory")
 
-    total_kwh = sum(session.get("Energy", 0) for session in sessions_data)
-    total_cost = total_kwh * nok_per_kwh
-
-    pdf_bytes = generate_invoice_pdf(
-        installation_id,
-        installation_name,
-        year,
-        month,
-        sessions_data,
-        total_kwh,
-        nok_per_kwh,
-        total_cost,
-    )
+    # ReportLab only writes the document once it is fully built, so the PDF is
+    # rendered before the response starts and a failure can still be reported.
+    try:
+        pdf_file = await run_in_threadpool(
+            spool_invoice_pdf,
+            form.installation_id,
+            form.installation_name,
+            form.year,
+            form.month,
+            sessions_data,
+            form.nok_per_kwh,
+        )
+    except Exception:
+        logger.exception("Failed to render the invoice PDF")
+        return redirect_with_error("pdf")
 
-    return Response(
-        pdf_bytes,
+    return StreamingResponse(
+        iter_file(pdf_file),
         media_type="application/pdf",
         headers={
-            "Content-Disposition": f'attachment;filename="{year}_{month:02d}_grunnlag_{make_safe_filename(installation_name)}.pdf"'
+            "Content-Disposition": f'attachment;filename="{form.year}_{form.month:02d}_grunnlag_{make_safe_filename(form.installation_name)}.pdf"'
         },
     )
 
 
 @app.get("/logout")
-async def logout(request: Request):
+async def logout(
+    request: Request,
+    token: str = Depends(get_token),
+    zaptec_api: ZaptecAPI = Depends(get_zaptec_api),
+):
     session_id = request.cookies.get("session_id")
     if session_id:
         delete_session(session_id)
+    if token:
+        zaptec_api.invalidate(token)
 
     response = RedirectResponse(url="/login", status_code=303)
     response.delete_cookie("session_id")
     return response
 
 
+@lru_cache(maxsize=1024)
 def make_safe_filename(filename):
-    safe_filename = re.sub(r'[<>:"/\\|?*]', "_", filename)
+    safe_filename = UNSAFE_FILENAME_RE.sub("_", filename)
     safe_filename = safe_filename.strip(" .").replace(" ", "_")
     return safe_filename
 
@@ -184,106 +358,179 @@ def make_safe_filename(filename):
 @app.post("/exportall", response_class=HTMLResponse)
 async def export_all_usage(
     request: Request,
-    year: int = Form(...),
-    month: int = Form(...),
-    nok_per_kwh: float = Form(...),
+    form: Annotated[ExportAllForm, Form()],
     token: str = Depends(get_token),
+    user: str = Depends(get_user),
+    zaptec_api: ZaptecAPI = Depends(get_zaptec_api),
 ):
-    if not (1 <= month <= 12) or year < 2000:
-        return templates.TemplateResponse(
-            "installations.html", {"request": request, "error": "Invalid date"}
-        )
-    if nok_per_kwh < 0:
-        return templates.TemplateResponse(
-            "installations.html", {"request": request, "error": "Invalid NOK per kWh"}
-        )
-
-    from_date = f"{year}-{month:02d}-01T00:00:00Z"
-
-    if month == 12:
-        to_date = f"{year + 1}-01-01T00:00:00Z"
-    else:
-        to_date = f"{year}-{month + 1:02d}-01T00:00:00Z"
+    from_date, to_date = month_bounds(form.year, form.month)
 
     try:
         installations = await zaptec_api.get_installations(token)
-    except Exception as e:
-        return templates.TemplateResponse(
-            "login.html", {"request": request, "error": str(e)}
-        )
-
-    pdfs: list[dict] = []
-
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        df_data: list[dict] = []
-        for installation in installations:
-            installation_id = installation.get("Id")
-            installation_name = installation.get("Name")
-            try:
-                sessions_data = await zaptec_api.get_chargehistory(
-                    token,
-                    installation_id,
-                    from_date,
-                    to_date,
-                )
-            except Exception:
-                continue
-
-            total_kwh = round(
-                sum(session.get("Energy", 0) for session in sessions_data), 3
+    except Exception:
+        logger.exception("Failed to fetch installations")
+        return redirect_with_error("installations")
+
+    semaphore = asyncio.Semaphore(CHARGEHISTORY_CONCURRENCY)
+
+    async def fetch_chargehistory(installation_id):
+        async with semaphore:
+            return await get_chargehistory(
+                zaptec_api,
+                token,
+                user,
+                installation_id,
+                from_date,
+                to_date,
             )
-            total_cost = round(total_kwh * nok_per_kwh, 2)
-            filename = f"{year}_{month:02d}_grunnlag_{make_safe_filename(installation_name)}.pdf"
 
-            df_data.append(
+    sessions_results = await asyncio.gather(
+        *[
+            fetch_chargehistory(installation.get("Id"))
+            for installation in installations
+        ],
+        return_exceptions=True,
+    )
+
+    # Installations whose history could not be fetched get no PDF, but are
+    # still listed in the summaries so they are not missed when invoicing.
+    pdf_jobs = []
+    failed_rows: list[dict] = []
+    for installation, sessions_data in zip(installations, sessions_results):
+        installation_id = installation.get("Id")
+        installation_name = installation.get("Name")
+        if isinstance(sessions_data, BaseException):
+            logger.error(
+                "Failed to fetch charge history for installation %s",
+                installation_id,
+                exc_info=sessions_data,
+            )
+            failed_rows.append(
                 {
                     "installasjons_navn": installation_name,
                     "installasjons_id": installation_id,
-                    "filnavn": filename,
-                    "sum_kwh": total_kwh,
-                    "sum_kroner": total_cost,
+                    "filnavn": None,
+                    "sum_kwh": None,
+                    "sum_kroner": None,
+                    "status": "Kunne ikke hente ladehistorikk",
                 }
             )
+            continue
 
-            pdf_bytes = generate_invoice_pdf(
+        pdf_jobs.append(
+            (
                 installation_id,
                 installation_name,
-                year,
-                month,
+                form.year,
+                form.month,
                 sessions_data,
-                total_kwh,
-                nok_per_kwh,
-                total_cost,
-            )
-            pdfs.append(
-                {
-                    "filename": filename,
-                    "bytes": pdf_bytes,
-                }
+                form.nok_per_kwh,
             )
-            zip_file.writestr(
-                f"{year}_{month:02d}_grunnlag_{make_safe_filename(installation_name)}.pdf",
-                pdf_bytes,
-            )
-        df = pl.DataFrame(df_data)
-        excel_buffer = io.BytesIO()
-        df.write_excel(excel_buffer)
-        excel_buffer.seek(0)
-        csv_buffer = io.BytesIO()
-        df.write_csv(csv_buffer)
-        csv_buffer.seek(0)
-
-        zip_file.writestr(
-            f"{year}_{month:02d}_grunnlag_oversikt.xlsx", excel_buffer.getvalue()
-        )
-        zip_file.writestr(
-            f"{year}_{month:02d}_grunnlag_oversikt.csv", csv_buffer.getvalue()
         )
 
-    zip_buffer.seek(0)
+    # The archive is completed before the response starts, so a failed render
+    # can still be reported. It is spooled to disk once it grows, and only the
+    # PDFs in the render window are held in memory.
+    pdf_executor = request.app.state.pdf_executor
+    archive = tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE)
+    try:
+        # PDFs and XLSX files are already compressed internally, so they are
+        # stored as-is. Only the CSV is worth a quick deflate.
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_STORED) as zip_file:
+            df_data: list[dict] = []
+            async with aclosing(render_invoice_pdfs(pdf_executor, pdf_jobs)) as results:
+                async for job, (pdf_bytes, total_kwh, total_cost) in results:
+                    installation_id, installation_name, *_ = job
+                    filename = f"{form.year}_{form.month:02d}_grunnlag_{make_safe_filename(installation_name)}.pdf"
+                    df_data.append(
+                        {
+                            "installasjons_navn": installation_name,
+                            "installasjons_id": installation_id,
+                            "filnavn": filename,
+                            "sum_kwh": total_kwh,
+                            "sum_kroner": total_cost,
+                            "status": "OK",
+                        }
+                    )
+                    await run_in_threadpool(zip_file.writestr, filename, pdf_bytes)
+
+            # Both summaries are written off the event loop, side by side.
+            df = pl.DataFrame(df_data + failed_rows)
+            excel_buffer = io.BytesIO()
+            csv_buffer = io.BytesIO()
+            await asyncio.gather(
+                run_in_threadpool(df.write_excel, excel_buffer),
+                run_in_threadpool(df.write_csv, csv_buffer),
+            )
+
+            await run_in_threadpool(
+                zip_file.writestr,
+                f"{form.year}_{form.month:02d}_grunnlag_oversikt.xlsx",
+                excel_buffer.getvalue(),
+            )
+            await run_in_threadpool(
+                zip_file.writestr,
+                f"{form.year}_{form.month:02d}_grunnlag_oversikt.csv",
+                csv_buffer.getvalue(),
+                compress_type=zipfile.ZIP_DEFLATED,
+                compresslevel=1,
+            )
+    except BrokenProcessPool:
+        archive.close()
+        logger.exception("A PDF worker died, starting a new pool")
+        replace_pdf_executor(request.app, pdf_executor)
+        return redirect_with_error("pdf")
+    except Exception:
+        archive.close()
+        logger.exception("Failed to build the export archive")
+        return redirect_with_error("pdf")
+
+    archive.seek(0)
     return StreamingResponse(
-        zip_buffer,
+        iter_file(archive),
         media_type="application/zip",
-        headers={"Content-Disposition": f"attachment; filename={year}_{month:02d}.zip"},
+        headers={
+            "Content-Disposition": f"attachment; filename={form.year}_{form.month:02d}.zip"
+        },
     )
+
+
+async def render_invoice_pdfs(executor: ProcessPoolExecutor, jobs: list[tuple]):
+    """
+    Render invoice PDFs in the process pool and yield them in order.
+
+    At most one render per worker is submitted ahead of the one being consumed,
+    so finished PDFs do not pile up while the caller is still busy.
+
+    Yields:
+        tuple: The job arguments and the result of generate_invoice_pdf
+    """
+    loop = asyncio.get_running_loop()
+    pending = deque()
+    try:
+        for job in jobs:
+            pending.append(
+                (job, loop.run_in_executor(executor, generate_invoice_pdf, *job))
+            )
+            if len(pending) >= PDF_WORKERS:
+                ready, future = pending.popleft()
+                yield ready, await future
+
+        while pending:
+            ready, future = pending.popleft()
+            yield ready, await future
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+
+def iter_file(file: BinaryIO, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """
+    Read a file in chunks for a streaming response and close it afterwards.
+
+    Yields:
+        bytes: The next chunk of the file
+    """
+    with file:
+        while chunk := file.read(chunk_size):
+            yield chunk
@@ -1,37 +1,123 @@
-from typing import Dict, Any, List
+import asyncio
+import time
+from typing import Dict, Any, List, NamedTuple, Tuple
 import httpx
 
+# Installations rarely change, so they are kept per access token for a while.
+INSTALLATIONS_TTL = 300
+
+
+class ChargeSession(NamedTuple):
+    """
+    The fields of a Zaptec charge session that the invoices use.
+    """
+
+    start_time: str
+    end_time: str
+    device_name: str
+    energy: float
+
+
+def to_charge_sessions(data: List[Dict[str, Any]]) -> List[ChargeSession]:
+    return [
+        ChargeSession(
+            session.get("StartDateTime", "N/A"),
+            session.get("EndDateTime", "N/A"),
+            session.get("DeviceName", "N/A"),
+            session.get("Energy", 0) or 0,
+        )
+        for session in data
+    ]
+
 
 class ZaptecAPI:
-    def __init__(self, base_url: str):
-        self.base_url = base_url
+    def __init__(self, client: httpx.AsyncClient):
+        # The client is shared by the application and carries the base URL.
+        self.client = client
+        self._installations_cache: Dict[str, Tuple[float, List[Dict[str, Any]]]] = {}
+        self._installations_inflight: Dict[str, asyncio.Task] = {}
+        # The fixed part of every chargehistory query is encoded only once.
+        self._history_base_params = httpx.QueryParams(
+            {
+                # The invoices only use the session summary, so the
+                # per-session energy details are not requested.
+                "DetailLevel": 0,
+                "PageSize": 100,
+            }
+        )
 
     async def get_installations(self, token: str) -> List[Dict[str, Any]]:
-        url = f"{self.base_url}/api/installation"
+        now = time.monotonic()
+        cached = self._installations_cache.get(token)
+        if cached is not None and now - cached[0] < INSTALLATIONS_TTL:
+            return cached[1]
+
+        # Concurrent misses for the same token share a single upstream call.
+        # The fetch runs as its own task and is shielded, so a caller that goes
+        # away does not cancel it for the others.
+        task = self._installations_inflight.get(token)
+        if task is None:
+            task = asyncio.create_task(self._fetch_installations(token))
+            self._installations_inflight[token] = task
+            task.add_done_callback(
+                lambda _: self._installations_inflight.pop(token, None)
+            )
+        return await asyncio.shield(task)
+
+    async def _fetch_installations(self, token: str) -> List[Dict[str, Any]]:
+        url = "/api/installation"
         headers = {"Authorization": f"Bearer {token}"}
         params = {"PageSize": 100}
 
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, params=params, headers=headers)
-            if response.status_code != 200:
-                raise Exception(f"Failed to fetch installations: {response.text}")
-            return response.json().get("Data", [])
+        response = await self.client.get(url, params=params, headers=headers)
+        if response.status_code != 200:
+            raise Exception(f"Failed to fetch installations: {response.text}")
+        installations = response.json().get("Data", [])
+
+        now = time.monotonic()
+        # Drop expired entries so tokens that are no longer used do not pile up.
+        for key, (fetched_at, _) in list(self._installations_cache.items()):
+            if now - fetched_at >= INSTALLATIONS_TTL:
+                del self._installations_cache[key]
+        self._installations_cache[token] = (now, installations)
+        return installations
+
+    def invalidate(self, token: str) -> None:
+        self._installations_cache.pop(token, None)
 
     async def get_chargehistory(
         self, token: str, installation_id: str, from_date: str, to_date: str
-    ) -> List[Dict[str, Any]]:
-        url = f"{self.base_url}/api/chargehistory"
+    ) -> List[ChargeSession]:
+        url = "/api/chargehistory"
         headers = {"Authorization": f"Bearer {token}"}
-        params = {
-            "InstallationId": installation_id,
-            "From": from_date,
-            "To": to_date,
-            "DetailLevel": 1,
-            "PageSize": 100,
-        }
-
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, params=params, headers=headers)
-            if response.status_code != 200:
-                raise Exception(f"Failed to fetch charge history: {response.text}")
-            return response.json().get("Data", [])
+        params = self._history_base_params.merge(
+            {"InstallationId": installation_id, "From": from_date, "To": to_date}
+        )
+
+        response = await self.client.get(
+            url, params=params.set("PageIndex", 0), headers=headers
+        )
+        if response.status_code != 200:
+            raise Exception(f"Failed to fetch charge history: {response.text}")
+        body = response.json()
+        # Sessions are narrowed to the fields in use as each page is parsed,
+        # so the full session dicts are not kept around.
+        sessions = to_charge_sessions(body.get("Data", []))
+
+        # The first page tells how many there are; the rest are fetched at once.
+        pages = body.get("Pages", 1)
+        if pages > 1:
+            responses = await asyncio.gather(
+                *[
+                    self.client.get(
+                        url, params=params.set("PageIndex", page), headers=headers
+                    )
+                    for page in range(1, pages)
+                ]
+            )
+            for response in responses:
+                if response.status_code != 200:
+                    raise Exception(f"Failed to fetch charge history: {response.text}")
+                sessions.extend(to_charge_sessions(response.json().get("Data", [])))
+
+        return sessions